@@ -16,7 +16,7 @@ class Install(_PackageAction):
         extend the install list with the unmet dependencies, creating a
         sensible order of package installations.
         """
-        installed_packages = list(self._user_data.installed_packages)
+        installed_packages = frozenset(self._user_data.installed_packages)
         result = list()
 
         def _walk(package):
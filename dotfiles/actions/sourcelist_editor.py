@@ -1,3 +1,4 @@
+from bisect import bisect_left
 import cmd
 import errno
 import os
@@ -7,12 +8,17 @@ import sys
 from dotfiles import sourcelist
 
 
+# The answers accepted by read_bool() as a yes or a no.
+_YES_ANSWERS = frozenset({'y', 'Y', '1', "yes", "Yes", "YES"})
+_NO_ANSWERS = frozenset({'n', 'N', '0', "no", "No", "NO"})
+
+
 def read_bool(prompt, default=True):
     default_txt = "[Y/n]" if default else "[y/N]"
     ret = input(prompt + " " + default_txt + " ")
-    if ret == 'y' or ret == 'Y' or ret == '1':
+    if ret in _YES_ANSWERS:
         return True
-    if ret == 'n' or ret == 'N' or ret == '0':
+    if ret in _NO_ANSWERS:
         return False
     if not ret:
         return default
@@ -34,6 +40,8 @@ configuration file for the Dotfiles manager framework.
         self._filepath = sl_path
         self._sourcelist = None
         self._exiting = False
+        # The sorted names of the sources, for prefix completion.
+        self._name_index = None
 
     def postcmd(self, stop, line):
         self.prompt = "(dotfiles-sourcelist%s) " \
@@ -49,8 +57,12 @@ configuration file for the Dotfiles manager framework.
         if not self._sourcelist:
             return
 
-        return [entry.name for entry in self._sourcelist.sources
-                if entry.name.startswith(text)]
+        if self._name_index is None:
+            self._name_index = sorted(entry.name for entry
+                                      in self._sourcelist.sources)
+        begin = bisect_left(self._name_index, text)
+        end = bisect_left(self._name_index, text + '\uffff', begin)
+        return self._name_index[begin:end]
 
     def do_load(self, arg):
         """Load the sources from the configuration file on the disk.
@@ -72,6 +84,7 @@ configuration file for the Dotfiles manager framework.
         print("Loading configuration from '%s'..." % self._filepath)
         try:
             self._sourcelist = sourcelist.SourceList(self._filepath)
+            self._name_index = None
             self._sourcelist.load()
             self.status_changed = False
         except Exception as e:
@@ -115,10 +128,8 @@ configuration file for the Dotfiles manager framework.
         print()
         type_choice = input("Please select the type of the entry: ")
 
-        try:
-            entry_cls = list(filter(lambda x: x.type_key == type_choice,
-                                    sourcelist.SUPPORTED_ENTRIES))[0]
-        except IndexError:
+        entry_cls = sourcelist.SUPPORTED_ENTRIES_BY_KEY.get(type_choice)
+        if not entry_cls:
             print("ERROR: There is no source list entry kind '%s'"
                   % type_choice,
                   file=sys.stderr)
@@ -140,6 +151,7 @@ configuration file for the Dotfiles manager framework.
 
         try:
             self._sourcelist.add_source(config)
+            self._name_index = None
             self.status_changed = True
         except Exception as e:
             print("Error: %s" % str(e), file=sys.stderr)
@@ -158,6 +170,7 @@ configuration file for the Dotfiles manager framework.
 
         try:
             self._sourcelist.delete_source(arg)
+            self._name_index = None
             self.status_changed = True
         except Exception as e:
             print("Error: %s" % str(e), file=sys.stderr)
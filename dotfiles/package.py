@@ -1,4 +1,5 @@
-import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 import os
 import shutil
 import zipfile
@@ -9,6 +10,7 @@ from dotfiles.os import restore_working_directory
 from dotfiles.stages import Stages
 from dotfiles.status import Status, require_status
 from dotfiles.temporary import package_temporary_dir, temporary_dir
+from dotfiles.transformers import scan_transforms
 
 
 K_LONG_DESCRIPTION = "description"
@@ -28,6 +30,33 @@ K_INSTALL = "install"
 K_UNINSTALL_GENERATED = "generated uninstall"
 K_UNINSTALL_USER_DEFINED = "uninstall"
 
+# Size of the buffer used when reading package descriptor files, large enough
+# to read most descriptors in a single system call.
+_DESCRIPTOR_BUFFER_SIZE = 128 * 1024
+
+# Package resources are mostly small text files, for which the fastest deflate
+# level gives almost the same ratio as the default one.
+_ARCHIVE_COMPRESS_LEVEL = 1
+
+# Size of the buffer used when streaming resource files between the disk and
+# the package archives.
+_COPY_BUFFER_SIZE = 1 << 20
+
+# Resource files with these extensions are already compressed, there is no
+# point in deflating them again when saving the package to an archive.
+_ARCHIVE_STORED_EXTENSIONS = {'.7z', '.bz2', '.gif', '.gz', '.jpeg', '.jpg',
+                              '.png', '.xz', '.zip', '.zst'}
+
+# The parts of the package descriptor which are relevant when checking the
+# conditions of executing a particular stage. `None` refers to the descriptor
+# itself.
+_CONDITION_SECTIONS_OF_STAGE = {
+    Stages.NON_DESCRIPT: (None,),
+    Stages.PREPARE: (None, K_PREPARE),
+    Stages.INSTALL: (None, K_PREPARE, K_INSTALL),
+    Stages.UNINSTALL: (None, K_UNINSTALL_USER_DEFINED, K_UNINSTALL_GENERATED)
+}
+
 
 class ExecutorError(Exception):
     """
@@ -90,11 +119,12 @@ class Package:
         """
         Extract the name of the package from the file path of the package's
         metadata file.
+
+        `path` must be under `root`, as it is the case when `root` is walked.
         """
-        return os.path.dirname(path) \
-            .replace(root, '', 1) \
-            .replace(os.sep, '.') \
-            .lstrip('.')
+        return os.path.dirname(path)[len(root):] \
+            .lstrip(os.sep) \
+            .replace(os.sep, '.')
 
     def __init__(self, root_name, root_path, logical_name, datafile_path):
         self.root = root_name
@@ -111,18 +141,44 @@ class Package:
 
         self._teardown = []
 
-        with open(datafile_path, 'r') as datafile:
-            self._data = yaml.load_yaml(datafile, Loader=yaml.Loader)
-            if not self._data:
-                self._data = dict()
+        # The descriptor file is only parsed when its contents are first
+        # needed.
+        self._loaded_data = None
 
         self._expander = ArgumentExpander()
         self._expander.register_expansion('PACKAGE_DIR', self.resource_dir)
         self._expander.register_expansion('SESSION_DIR', temporary_dir())
 
-        # Validate package YAML structure.
+    @property
+    def _data(self):
+        """
+        The contents of the package's descriptor file, which is loaded and
+        validated on first access.
+        """
+        if self._loaded_data is None:
+            try:
+                # Only the descriptors under a package root have a stable
+                # path. Packages loaded from an archive are extracted to a
+                # new temporary directory in every run.
+                data = yaml.load_yaml_file(
+                    self.datafile, Loader=yaml.PackageLoader,
+                    buffering=_DESCRIPTOR_BUFFER_SIZE,
+                    cache=bool(self._root_path))
+            except yaml.YAMLError:
+                raise ValueError("Package data file for '%s' is corrupt."
+                                 % self.name)
+
+            self._loaded_data = data if data else dict()
+            self._validate()
+        return self._loaded_data
+
+    def _validate(self):
+        """
+        Validate the package YAML structure.
+        """
         # TODO: This list of error cases is not full.
         if self.is_support and self.has_uninstall:
+            self._loaded_data = None
             raise PackageMetadataError(self,
                                        "Package marked as a support but has "
                                        "an 'uninstall' section!")
@@ -142,25 +198,18 @@ class Package:
                 # We found the *first* root to load the package from under.
                 break
 
-        if not datafile:
+        if not datafile or not os.path.isfile(datafile):
             raise KeyError("Package data file for '%s' was not found."
                            % logical_name)
 
-        try:
-            instance = Package(used_root_name, used_root_path, logical_name,
-                               datafile)
+        instance = Package(used_root_name, used_root_path, logical_name,
+                           datafile)
 
-            # A package loaded from the disk doesn't need anything extra
-            # to load its resources.
-            instance.__setattr__('_load_resources', lambda: None)
+        # A package loaded from the disk doesn't need anything extra to load
+        # its resources.
+        instance.__setattr__('_load_resources', lambda: None)
 
-            return instance
-        except FileNotFoundError:
-            raise KeyError("Package data file for '%s' was not found."
-                           % logical_name)
-        except yaml.YAMLError:
-            raise ValueError("Package data file for '%s' is corrupt."
-                             % logical_name)
+        return instance
 
     @classmethod
     def create_from_archive(cls, logical_name, archive):
@@ -185,23 +234,57 @@ class Package:
             to the temporary directory when needed.
             """
             with zipfile.ZipFile(archive.filename, 'r') as zipf:
-                for file in zipf.namelist():
-                    if not file.startswith('$PACKAGE_DIR/'):
-                        continue
-
-                    zipf.extract(file, package_dir)
-
-                    # Temporary is extracted by keeping the '$PACKAGE_DIR/'
-                    # directory, thus it has to be moved one level up.
-                    without_prefix = file.replace('$PACKAGE_DIR/', '', 1)
-                    os.makedirs(
-                        os.path.join(package_dir,
-                                     os.path.dirname(without_prefix)),
-                        exist_ok=True)
-                    shutil.move(os.path.join(package_dir, file),
-                                os.path.join(package_dir, without_prefix))
-            shutil.rmtree(os.path.join(package_dir, '$PACKAGE_DIR'),
-                          ignore_errors=True)
+                members = [file for file in zipf.namelist()
+                           if file.startswith('$PACKAGE_DIR/')]
+
+            real_package_dir = os.path.realpath(package_dir)
+
+            def _target_of(file):
+                # The resources are stored under the '$PACKAGE_DIR/'
+                # directory in the archive, but they are written directly one
+                # level up. Members must not escape the package's directory.
+                target = os.path.normpath(
+                    os.path.join(package_dir,
+                                 file.replace('$PACKAGE_DIR/', '', 1)))
+                if os.path.commonpath([os.path.realpath(target),
+                                       real_package_dir]) != \
+                        real_package_dir:
+                    raise ValueError("Archive member '%s' of package '%s' "
+                                     "points outside the package."
+                                     % (file, logical_name))
+                return target
+
+            # Explicit directory entries are only created, the files are
+            # extracted.
+            directories = {_target_of(file) for file in members
+                           if file.endswith('/')}
+            members = [(file, _target_of(file)) for file in members
+                       if not file.endswith('/')]
+
+            def _extract(files):
+                # A ZipFile instance must not be shared between threads, but
+                # the same archive can be opened multiple times.
+                with zipfile.ZipFile(archive.filename, 'r') as zipf:
+                    for file, target in files:
+                        with zipf.open(file) as source, \
+                                open(target, 'wb') as destination:
+                            shutil.copyfileobj(source, destination,
+                                               _COPY_BUFFER_SIZE)
+
+            # Create the directory structure up front, so the workers do not
+            # race each other creating the same directories.
+            for directory in directories | {os.path.dirname(target)
+                                            for _, target in members}:
+                os.makedirs(directory, exist_ok=True)
+
+            if members:
+                # Decompression releases the GIL, so the resources are
+                # extracted by multiple workers.
+                workers = min(os.cpu_count() or 1, len(members))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(_extract,
+                                      [members[i::workers]
+                                       for i in range(workers)]))
 
             # Subsequent calls to self._load_resources() shouldn't do anything.
             instance.__setattr__('_load_resources', lambda: None)
@@ -238,12 +321,20 @@ class Package:
                     # will be saved instead.
                     continue
 
+                if os.path.splitext(file)[1].lower() in \
+                        _ARCHIVE_STORED_EXTENSIONS:
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+
                 archive.write(os.path.join(dirpath, file),
                               os.path.join(arcpath, file),
-                              compress_type=zipfile.ZIP_DEFLATED)
+                              compress_type=compress_type,
+                              compresslevel=_ARCHIVE_COMPRESS_LEVEL)
 
         archive.writestr('package.yaml', package.serialize(),
-                         compress_type=zipfile.ZIP_DEFLATED)
+                         compress_type=zipfile.ZIP_DEFLATED,
+                         compresslevel=_ARCHIVE_COMPRESS_LEVEL)
 
     @property
     def root_path(self):
@@ -288,45 +379,52 @@ class Package:
         """
         return self._data.get(K_LONG_DESCRIPTION, None)
 
-    def has_condition_directive(self, condition, for_stage=Status.ANY):
+    @cached_property
+    def _condition_index(self):
         """
-        Returns if the current package mentions the `condition` in its
-        descriptor, in the context of the action stage given as `for_stage`.
+        The identifiers of the conditions mentioned in the package
+        descriptor, separately for the descriptor itself (keyed `None`) and
+        for each of its action lists.
         """
         def _make_key(k, meta_syntax):
             return "$" + k if meta_syntax else k
 
-        def _check_elem(e, metakey_syntax=True):
+        def _conditions_of_elem(e, metakey_syntax=True):
             if type(e) is not dict:
-                raise TypeError("Expected dict in _check_elem.")
+                raise TypeError("Expected dict in _conditions_of_elem.")
 
-            required = e.get(_make_key(K_CONDITIONAL_POSITIVE, metakey_syntax),
-                             list())
-            blocking = e.get(_make_key(K_CONDITIONAL_NEGATIVE,
-                                       metakey_syntax),
-                             list())
+            conditions = set()
+            for key in (K_CONDITIONAL_POSITIVE, K_CONDITIONAL_NEGATIVE):
+                value = e.get(_make_key(key, metakey_syntax), list())
+                if isinstance(value, str):
+                    value = [value]
+                conditions.update(value)
+            return conditions
 
-            return condition.value.IDENTIFIER in required or \
-                condition.value.IDENTIFIER in blocking
-
-        def _check_list(li):
+        def _conditions_of_list(li):
             if type(li) is not list:
-                raise TypeError("Expected list in _check_list.")
-            return any(map(_check_elem, li))
-
-        if for_stage == Stages.NON_DESCRIPT:
-            return _check_elem(self._data, metakey_syntax=False)
-        if for_stage == Stages.PREPARE:
-            return _check_elem(self._data, metakey_syntax=False) or \
-                _check_list(self._data.get(K_PREPARE, []))
-        if for_stage == Stages.INSTALL:
-            return _check_elem(self._data, metakey_syntax=False) or \
-                _check_list(self._data.get(K_PREPARE, [])) or \
-                _check_list(self._data.get(K_INSTALL, []))
-        if for_stage == Stages.UNINSTALL:
-            return _check_elem(self._data, metakey_syntax=False) or \
-                _check_list(self._data.get(K_UNINSTALL_USER_DEFINED, [])) or \
-                _check_list(self._data.get(K_UNINSTALL_USER_DEFINED, []))
+                raise TypeError("Expected list in _conditions_of_list.")
+            return set().union(*map(_conditions_of_elem, li))
+
+        index = {None: frozenset(_conditions_of_elem(self._data,
+                                                     metakey_syntax=False))}
+        for key in (K_PREPARE, K_INSTALL,
+                    K_UNINSTALL_USER_DEFINED, K_UNINSTALL_GENERATED):
+            index[key] = frozenset(
+                _conditions_of_list(self._data.get(key, list())))
+        return index
+
+    def has_condition_directive(self, condition, for_stage=Status.ANY):
+        """
+        Returns if the current package mentions the `condition` in its
+        descriptor, in the context of the action stage given as `for_stage`.
+        If `for_stage` is not a stage, every part of the descriptor is
+        considered.
+        """
+        sections = _CONDITION_SECTIONS_OF_STAGE.get(for_stage,
+                                                    self._condition_index)
+        return any(condition.value.IDENTIFIER in self._condition_index[section]
+                   for section in sections)
 
     @property
     def is_support(self):
@@ -351,7 +449,7 @@ class Package:
         """
         return self._data.get(K_WILL_AUTO_INSTALL_PARENT, True)
 
-    @property
+    @cached_property
     def parent(self):
         """
         Returns the logical name of the package that SHOULD BE the parent
@@ -362,13 +460,16 @@ class Package:
         """
         return '.'.join(self.name.split('.')[:-1])
 
-    @property
+    @cached_property
     def dependencies(self):
         """
         Get the list of all dependencies the package metadata file describes.
 
         There are no guarantees that the packages named actually refer to
         installable packages.
+
+        The list is calculated only once, the dependencies of a package do not
+        change after its descriptor is loaded.
         """
         return self._data.get(K_DEPENDENCIES, []) + \
             ([self.parent] if self.depends_on_parent and self.parent
@@ -407,18 +508,27 @@ class Package:
             Always returns a `list` of steps, even if the transformation of
             one step resulted in precisely one step.
         """
-        steps = [action_list[index]]
+        # Each step is kept together with its parsed transformer configuration,
+        # which stays valid as long as a transformer passes the step on. New
+        # steps created by a transformer are parsed when they are first seen.
+        steps = [(action_list[index], None)]
         for xform in transformers:
             transform_results = list()
-            for step in steps:
-                step_transformed = xform(stage, step)
+            for step, scanned in steps:
+                if scanned is None:
+                    scanned = scan_transforms(step)
+                step_transformed = xform(stage, step, scanned)
                 if type(step_transformed) is dict:
-                    transform_results.append(step_transformed)
-                elif type(step_transformed) is list:
-                    transform_results.extend(step_transformed)
+                    step_transformed = [step_transformed]
+                if type(step_transformed) is list:
+                    transform_results.extend(
+                        (result, scanned if result is step else None)
+                        for result in step_transformed)
             steps = transform_results
 
+        steps = [step for step, _ in steps]
         action_list[index:index + 1] = steps
+        self.__dict__.pop('_condition_index', None)
         return steps
 
     def _execute_steps(self, action_list_key, stage, executor, transformers):
@@ -492,7 +602,8 @@ class Package:
         if uninstall_generator.actions:
             # Save the uninstall actions to the package's data.
             self._data[K_UNINSTALL_GENERATED] = \
-                list(uninstall_generator.actions)
+                list(reversed(uninstall_generator.actions))
+            self.__dict__.pop('_condition_index', None)
 
     @property
     def has_uninstall(self):
@@ -543,75 +654,65 @@ class _PackageTree:
     """Represents the logical tree of package names in an internal data
     structure."""
     def __init__(self):
-        self._dict = dict()
-
-    def get_tree(self, name):
-        """Return the dict of packages that are subpackages of the specified
-        name.
-        """
-        # A namespace package is a package name that doesn't contain any
-        # installation, only provides a logical directory name for packages.
-        can_be_namespace = True
-
-        work_dict = self._dict  # Start from the top.
-        for part in name.split('.'):
-            sub_dict = work_dict.get(part, dict())
-            if not sub_dict:
-                work_dict[part] = sub_dict
-            work_dict = sub_dict
-
-            if work_dict.get("__SELF__"):
-                # The current package we are walking is not a namespace
-                # anymore.
-                can_be_namespace = False
-
-        return work_dict, can_be_namespace
+        # The names of the registered packages.
+        self._registered = set()
+        # Every name that appears in the logical structure, either as a
+        # package or as a "directory" (a parent) of a package.
+        self._all_prefixes = set()
 
     @property
     def packages(self):
         """Generates the list of registered packages."""
-        keys_to_visit = list(self._dict.keys())
-        while keys_to_visit:
-            key = keys_to_visit.pop(0)
-            dict_for_key, _ = self.get_tree(key)
-            for subkey in dict_for_key.keys():
-                if subkey == "__SELF__" and dict_for_key[subkey]:
-                    yield key
-                if isinstance(dict_for_key[subkey], dict):
-                    keys_to_visit.append(key + '.' + subkey)
+        yield from self._registered
 
     def is_name(self, name):
         """Returns whether the package tree with the given name was
         encountered, i.e. it exists as a "directory" in the logical structure.
         """
-        dict_for_name, _ = self.get_tree(name)
-        # The name has been encountered if it has at least a child, and thus
-        # the dict is not empty.
-        return bool(dict_for_name)
+        return name in self._all_prefixes
 
     def is_registered(self, name):
         """Returns whether the given name represent a package."""
-        dict_for_name, is_namespace = self.get_tree(name)
-        return not is_namespace and dict_for_name["__SELF__"]
+        return name in self._registered
 
     def has_any_non_namespace_parents(self, name):
         """Returns whether the given package name in the current package tree
         has any non-namespace (i.e. actual package) parents.
         """
-        name_parts = name.split('.')
-        name_prefixes = ['.'.join(name_parts[:num])
-                         for num in range(len(name_parts))]
-        for prefix in name_prefixes:
-            _, can_be_namespace = self.get_tree(prefix)
-            if not can_be_namespace:
+        # A namespace package is a package name that doesn't contain any
+        # installation, only provides a logical directory name for packages.
+        parts = name.split('.')
+        prefix = parts[0]
+        for part in parts[1:]:
+            if prefix in self._registered:
                 return True
+            prefix += '.' + part
 
         return False
 
     def register_package(self, name):
         """Add the given package name to the tree."""
-        dict_for_package, _ = self.get_tree(name)
-        dict_for_package["__SELF__"] = True
+        self._registered.add(name)
+
+        parts = name.split('.')
+        prefix = parts[0]
+        self._all_prefixes.add(prefix)
+        for part in parts[1:]:
+            prefix += '.' + part
+            self._all_prefixes.add(prefix)
+
+
+def _scan_root(root_path):
+    """
+    Returns the logical name of every package found under `root_path`, in the
+    order the directory walk encountered them.
+    """
+    names = list()
+    for dirpath, _, files in os.walk(root_path):
+        if 'package.yaml' in files:
+            names.append(Package.data_file_to_package_name(
+                root_path, os.path.join(dirpath, 'package.yaml')))
+    return names
 
 
 def get_package_names(root_map):
@@ -619,6 +720,16 @@ def get_package_names(root_map):
     Returns the logical name of packages that are available under the specified
     roots.
     """
+    if not root_map:
+        return
+
+    # Walking the roots is bound by the latency of the file system, so the
+    # roots are scanned in parallel, but the results are processed in the
+    # priority order of the roots.
+    with ThreadPoolExecutor(max_workers=min(8, len(root_map))) as executor:
+        scans = [executor.submit(_scan_root, root_path)
+                 for root_path in root_map.values()]
+
     # It has to be ensured that if more roots are loaded, packages under a
     # subsequent root will neither override, nor extend with subpackage the
     # trees found in earlier roots.
@@ -627,22 +738,19 @@ def get_package_names(root_map):
     # search.
     package_tree = _PackageTree()
 
-    for root, root_path in root_map.items():
+    for scan in scans:
         packages_in_current_root = _PackageTree()
 
-        for dirpath, _, files in os.walk(root_path):
-            for match in fnmatch.filter(files, 'package.yaml'):
-                logical_package_name = Package.data_file_to_package_name(
-                    root_path, os.path.join(dirpath, match))
-                if package_tree.has_any_non_namespace_parents(
-                            logical_package_name) or \
-                        package_tree.is_registered(logical_package_name):
-                    # If the to-be-registered package or a parent name has
-                    # already been shadowed by a package from a previous
-                    # root, do not register it.
-                    continue
-                packages_in_current_root.register_package(logical_package_name)
-                yield logical_package_name
+        for logical_package_name in scan.result():
+            if package_tree.has_any_non_namespace_parents(
+                        logical_package_name) or \
+                    package_tree.is_registered(logical_package_name):
+                # If the to-be-registered package or a parent name has
+                # already been shadowed by a package from a previous
+                # root, do not register it.
+                continue
+            packages_in_current_root.register_package(logical_package_name)
+            yield logical_package_name
 
         for package in packages_in_current_root.packages:
             package_tree.register_package(package)
@@ -660,34 +768,39 @@ def get_dependencies(package_store, package, ignore=None):
         if these packages are encountered, the dependency chain walk does not
         continue.
     """
-    # This recursion isn't the fastest algorithm for creating dependencies,
-    # but due to the relatively small size and scope of the project, this
-    # will do.
-    if ignore is None:
-        ignore = list()
+    # A frozenset passed as `ignore` is not copied.
+    ignore = frozenset(ignore) if ignore else frozenset()
     if package.name in ignore:
         return list()
 
+    # Walk the dependency graph iteratively. Every package is expanded at most
+    # once, as the names already visited (or ignored) are not walked again.
+    seen = {package.name}
     dependencies = list()
-    for dependency in set(package.dependencies) - set(ignore):
-        try:
-            # Check if the dependency exists.
-            dependency_obj = package_store[dependency]
-        except KeyError:
-            if dependency == package.parent:
-                # Don't consider dependency on the parent an error if the
-                # parent does not exist as a real package.
+    stack = [package]
+    while stack:
+        current = stack.pop()
+        for dependency in current.dependencies:
+            if dependency in seen or dependency in ignore:
                 continue
 
-            raise KeyError("Dependency '%s' for '%s' was not found as a "
-                           "package."
-                           % (dependency, package.name))
+            try:
+                # Check if the dependency exists.
+                dependency_obj = package_store[dependency]
+            except KeyError:
+                if dependency == current.parent:
+                    # Don't consider dependency on the parent an error if the
+                    # parent does not exist as a real package.
+                    continue
+
+                raise KeyError("Dependency '%s' for '%s' was not found as a "
+                               "package."
+                               % (dependency, current.name))
 
-        # If the dependency exists as a package, it is a dependency.
-        dependencies += [dependency]
-        # And walk the dependencies of the now found dependency.
-        dependencies.extend(get_dependencies(package_store,
-                                             dependency_obj,
-                                             ignore + [package.name]))
+            # If the dependency exists as a package, it is a dependency, and
+            # the dependencies of it must also be walked.
+            seen.add(dependency)
+            dependencies.append(dependency)
+            stack.append(dependency_obj)
 
     return dependencies
@@ -1,13 +1,58 @@
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
+import copy
+import mmap
 import os
+import pickle
+import re
+import shlex
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
 
 from dotfiles import yaml
 from dotfiles.os import cache_directory, config_directory, data_directory, \
-    restore_working_directory, umask
+    umask
+
+# The libgit2 bindings, if available, allow querying and configuring the
+# local repositories without spawning a Git client process for each step.
+# They are only imported when a Git source is first set up, and this is False
+# if they are not installed.
+_PYGIT2 = None
+
+
+def _import_pygit2():
+    """Returns the `pygit2` module, or None if it is not installed."""
+    global _PYGIT2
+    if _PYGIT2 is None:
+        try:
+            import pygit2
+            _PYGIT2 = pygit2
+        except ImportError:
+            _PYGIT2 = False
+    return _PYGIT2 or None
+
+
+# Refspecs that look like (abbreviated) commit hashes. These name immutable
+# objects, so if they are already present locally, no fetch is needed.
+_SHA_RE = re.compile(r"^[0-9a-f]{7,40}$")
+
+# The parsed contents of the source list are cached in this file of the user's
+# cache directory, keyed by the path, modification time and size of the source
+# list file they were read from.
+_PARSED_CACHE_FILE = "sourcelist.pickle"
+
+# The source lists parsed by this process, keyed in the same way, with the
+# least recently used one evicted first once the limit is reached. Callers
+# always receive a copy, as the loaded list is mutated by the editing methods.
+_PARSE_CACHE = OrderedDict()
+_PARSE_CACHE_SIZE = 16
+
+# Source lists larger than this are parsed from a memory mapping of the file,
+# instead of being read through the file buffer in small chunks.
+_MMAP_THRESHOLD = 64 * 1024
 
 
 DEFAULT_SOURCE_LIST = [
@@ -34,12 +79,16 @@ class Option:
     def __init__(self, name, prompt, parser_fn=None, default=None):
         self.name = name
         self.prompt = prompt
-        self.parser_fn = parser_fn if parser_fn else lambda x: x
+        self.parser_fn = parser_fn
         self.default = default
+        self._input_prompt = '\t' + prompt + ' '
+
+    def _parse(self, value):
+        return self.parser_fn(value) if self.parser_fn else value
 
     def __call__(self):
         """Ask the user to specify an option."""
-        return self.parser_fn(input('\t' + self.prompt + ' '))
+        return self._parse(input(self._input_prompt))
 
     def from_entry(self, entry):
         """Fetch the value for the option from the given configuration file
@@ -49,6 +98,16 @@ class Option:
             return entry.get(self.name, self.default)
         return entry[self.name]
 
+    def from_dict(self, values):
+        """Parse the value for the option from an already collected mapping of
+        option names to values, instead of asking the user.
+        """
+        if self.name in values:
+            return self._parse(values[self.name])
+        if self.default is not None:
+            return self._parse(self.default)
+        raise KeyError("No value given for option '%s'" % self.name)
+
 
 def _no_special_in_name(name):
     if '/' in name or ' ' in name:
@@ -57,15 +116,22 @@ def _no_special_in_name(name):
 
 
 class SourceListEntry(metaclass=ABCMeta):
-    options = [Option("name",
+    options = (Option("name",
                       "Logical name for the package source?",
-                      _no_special_in_name)]
+                      _no_special_in_name),)
 
     def __init__(self, type_key, name):
         self._assembled_at = None
         self.type_key = type_key
         self.name = name
 
+    @classmethod
+    def from_values(cls, values):
+        """Create an instance from the given mapping of option names to values,
+        without prompting the user for any of the options.
+        """
+        return cls(*[opt.from_dict(values) for opt in cls.options])
+
     @abstractmethod
     def assemble(self, data_directory):  # noqa: F811
         """Overridden in the derived classes to execute the action needed in
@@ -86,10 +152,10 @@ class SourceListEntry(metaclass=ABCMeta):
 class LocalSource(SourceListEntry):
     type_key = "local"
     help = "Use a directory somewhere on the local machine as a package source"
-    options = [SourceListEntry.options[0],
+    options = (SourceListEntry.options[0],
                Option("directory", "The directory to mirror?",
                       lambda path: os.path.abspath(os.path.expanduser(path)))
-               ]
+               )
 
     def __init__(self, name, directory):
         super().__init__(LocalSource.type_key, name)
@@ -102,15 +168,23 @@ class LocalSource(SourceListEntry):
         # Create a symbolic link under the data_directory to the referred
         # directory.
         target_symlink = os.path.join(data_directory, self.name)
-        if os.path.exists(target_symlink):
-            try:
-                os.remove(target_symlink)
-            except IsADirectoryError:
+        try:
+            target_mode = os.lstat(target_symlink).st_mode
+            if stat.S_ISDIR(target_mode):
                 # The original directory did not exist and an empty one was
                 # created.
                 os.rmdir(target_symlink)
+            else:
+                os.unlink(target_symlink)
+        except FileNotFoundError:
+            pass
+
+        try:
+            is_dir = stat.S_ISDIR(os.stat(self.directory).st_mode)
+        except OSError:
+            is_dir = False
 
-        if not os.path.isdir(self.directory):
+        if not is_dir:
             print("[WARNING] The source directory of '%s', '%s' does not "
                   "exist."
                   % (self.name, self.directory))
@@ -125,7 +199,7 @@ class GitRepositorySource(SourceListEntry):
     type_key = "git repo"
     help = "Fetch the contents of a Git repository from an URL and use it " \
            "as a package source"
-    options = [SourceListEntry.options[0],
+    options = (SourceListEntry.options[0],
                Option("repository", "The repository URL to fetch from?"),
                Option("refspec", "The branch name or commit SHA1 to check "
                                  "out and use? "
@@ -135,13 +209,15 @@ class GitRepositorySource(SourceListEntry):
                                    "packages are located? "
                                    "(default: repo root) ",
                       default="")
-               ]
+               )
 
     def __init__(self, name, repository, refspec, directory):
         super().__init__(GitRepositorySource.type_key, name)
         self.repository = repository
         self.refspec = refspec
         self.directory = directory
+        self._repository = None
+        self._git = None
 
     def __str__(self):
         ret = "Git %s" % self.repository
@@ -151,28 +227,52 @@ class GitRepositorySource(SourceListEntry):
             ret += "/%s" % self.directory
         return ret
 
-    @restore_working_directory
     def _setup_git_remote(self):
-        os.chdir(self.__directory)
-        subprocess.check_call(["git", "init", '.'], stdout=subprocess.DEVNULL)
+        pygit2 = _import_pygit2()
+        if pygit2:
+            # Keep the handle to the repository for the rest of the assemble.
+            self._repository = pygit2.init_repository(self.__directory,
+                                                      bare=False)
+            try:
+                if self._repository.remotes["__dotfiles__repo__"].url != \
+                        self.repository:
+                    self._repository.remotes.set_url("__dotfiles__repo__",
+                                                     self.repository)
+            except KeyError:
+                self._repository.remotes.create("__dotfiles__repo__",
+                                                self.repository)
+            return
+
+        subprocess.check_call(self._git + ["init", '.'],
+                              stdout=subprocess.DEVNULL)
         try:
-            repo_url = subprocess.check_output(["git", "remote", "get-url",
+            repo_url = subprocess.check_output(self._git +
+                                               ["remote", "get-url",
                                                 "__dotfiles__repo__"],
                                                stderr=subprocess.DEVNULL)
-            repo_url = repo_url.decode()
+            repo_url = repo_url.decode().strip()
 
             if repo_url != self.repository:
-                subprocess.check_call(["git", "remote", "set-url",
+                subprocess.check_call(self._git +
+                                      ["remote", "set-url",
                                        "__dotfiles__repo__",
                                        self.repository])
         except subprocess.CalledProcessError:
-            subprocess.check_call(["git", "remote", "add",
+            subprocess.check_call(self._git +
+                                  ["remote", "add",
                                    "__dotfiles__repo__",
                                    self.repository])
 
     def _get_current_git_commit(self):
+        if self._repository is not None:
+            try:
+                return str(self._repository.head.target)
+            except _import_pygit2().GitError:
+                return ""
+
         try:
-            commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            commit = subprocess.check_output(self._git +
+                                             ["rev-parse", "HEAD"],
                                              stderr=subprocess.DEVNULL)
             commit = commit.decode().strip()
             return commit
@@ -180,8 +280,15 @@ class GitRepositorySource(SourceListEntry):
             return ""
 
     def _get_current_git_branch(self):
+        if self._repository is not None:
+            if self._repository.head_is_unborn or \
+                    self._repository.head_is_detached:
+                return ""
+            return self._repository.head.shorthand
+
         try:
-            branch = subprocess.check_output(["git", "rev-parse",
+            branch = subprocess.check_output(self._git +
+                                             ["rev-parse",
                                               "--abbrev-ref", "HEAD"],
                                              stderr=subprocess.DEVNULL)
             branch = branch.decode().strip()
@@ -191,26 +298,52 @@ class GitRepositorySource(SourceListEntry):
         except subprocess.CalledProcessError:
             return ""
 
+    def _has_local_commit(self):
+        """Returns whether the refspec is a commit hash that is already
+        available in the local repository.
+        """
+        if not _SHA_RE.match(self.refspec):
+            return False
+
+        # The refspec must resolve to a commit whose hash it is a prefix of,
+        # otherwise it is a branch or tag that merely looks like a hash.
+        if self._repository is not None:
+            try:
+                commit = self._repository.revparse_single(
+                    self.refspec + "^{commit}")
+                return str(commit.id).startswith(self.refspec)
+            except (KeyError, ValueError, _import_pygit2().GitError):
+                return False
+
+        try:
+            commit = subprocess.check_output(self._git +
+                                             ["rev-parse", "--verify",
+                                              "--quiet",
+                                              self.refspec + "^{commit}"],
+                                             stderr=subprocess.DEVNULL)
+            return commit.decode().strip().startswith(self.refspec)
+        except subprocess.CalledProcessError:
+            return False
+
     def _git_fetch(self):
         print("[DEBUG] Updating remote '%s'..." % self.name, file=sys.stderr)
-        subprocess.check_call(["git", "fetch", "--all", "--tags", "--prune"],
+        subprocess.check_call(self._git +
+                              ["fetch", "--all", "--tags", "--prune"],
                               stdout=subprocess.DEVNULL,
                               stderr=subprocess.DEVNULL)
 
     def _git_checkout(self):
         if self.refspec:
-            subprocess.run(["git", "branch", "-D", self.refspec],
+            subprocess.run(self._git + ["branch", "-D", self.refspec],
                            stdout=subprocess.DEVNULL,
                            stderr=subprocess.DEVNULL)
-        subprocess.check_call(["git", "checkout",
+        subprocess.check_call(self._git +
+                              ["checkout",
                                self.refspec if self.refspec else "FETCH_HEAD"],
                               stdout=subprocess.DEVNULL,
                               stderr=subprocess.DEVNULL)
 
-    @restore_working_directory
     def _git_set_to_refspec(self):
-        os.chdir(self.__directory)
-
         if not self.refspec:
             # Always update if the user didn't specify anything to check out.
             self._git_fetch()
@@ -223,6 +356,11 @@ class GitRepositorySource(SourceListEntry):
             # update.
             return
 
+        if self._has_local_commit():
+            # The commit is already downloaded, only a checkout is needed.
+            self._git_checkout()
+            return
+
         # Otherwise, the refspec is either a commit, or a branch name.
         if self._get_current_git_branch():
             # If the repository is set to track a remote branch, update, and
@@ -239,6 +377,29 @@ class GitRepositorySource(SourceListEntry):
             self._git_fetch()
             self._git_checkout()
 
+    def _run_git_batch(self, commands):
+        """Executes the given Git commands (each a list of arguments to Git) in
+        the repository as a single shell invocation, stopping at the first
+        failing one.
+        """
+        subprocess.check_call(" && ".join(shlex.join(self._git + command)
+                                          for command in commands),
+                              shell=True,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    def _git_clone(self):
+        """Sets up a repository that did not exist before. There is nothing
+        to decide about the state of the repository in this case, so every
+        step is executed in one go.
+        """
+        print("[DEBUG] Updating remote '%s'..." % self.name, file=sys.stderr)
+        self._run_git_batch(
+            [["init", '.'],
+             ["remote", "add", "__dotfiles__repo__", self.repository],
+             ["fetch", "--all", "--tags", "--prune"],
+             ["checkout", self.refspec if self.refspec else "FETCH_HEAD"]])
+
     def assemble(self, data_directory):  # noqa: F811
         # Git repositories might already exist, so to prevent useless
         # downloads by the client, first let us check if the repository exists.
@@ -248,9 +409,13 @@ class GitRepositorySource(SourceListEntry):
         os.makedirs(git_repo_dir, exist_ok=True)
 
         self.__directory = git_repo_dir
+        self._git = ["git", "-C", git_repo_dir]
 
-        self._setup_git_remote()
-        self._git_set_to_refspec()
+        if not os.path.exists(os.path.join(git_repo_dir, ".git")):
+            self._git_clone()
+        else:
+            self._setup_git_remote()
+            self._git_set_to_refspec()
 
         if self.directory:
             self.__directory = os.path.join(git_repo_dir, self.directory)
@@ -262,25 +427,59 @@ class GitRepositorySource(SourceListEntry):
 
         self._assembled_at = self.__directory
         del self.__directory
+        self._repository = None
+        self._git = None
 
 
 SUPPORTED_ENTRIES = [LocalSource, GitRepositorySource]
 
+# The source list entry class for each "type" value in the configuration.
+SUPPORTED_ENTRIES_BY_KEY = {clazz.type_key: clazz
+                            for clazz in SUPPORTED_ENTRIES}
+
 
 class SourceList:
     def __init__(self, path):
         self.path = path
         self._list = list()
-        self._entries = list()
+        self._entries = None  # Instantiated on demand.
+        self._index = dict()
+        self._roots = None
 
     def load(self):
         try:
-            with open(self.path, 'r') as listfile:
-                data = yaml.load_yaml(listfile, Loader=yaml.Loader)
-                self._list = data.get("sources", list())
-                self._create_entries()
+            stat_result = os.stat(self.path)
+            cache_key = (os.path.abspath(self.path),
+                         stat_result.st_mtime_ns,
+                         stat_result.st_size)
+
+            sources = _PARSE_CACHE.get(cache_key)
+            if sources is not None:
+                _PARSE_CACHE.move_to_end(cache_key)
+            else:
+                sources = SourceList._load_parsed_cache(cache_key)
+                if sources is None:
+                    # LibYAML decodes the UTF-8 input itself, so the file is
+                    # not read through a text wrapper.
+                    with open(self.path, 'rb') as listfile:
+                        if stat_result.st_size > _MMAP_THRESHOLD:
+                            data = SourceList._load_mapped(listfile)
+                        else:
+                            data = yaml.load_yaml(listfile,
+                                                  Loader=yaml.Loader)
+                        sources = data.get("sources", list())
+                    SourceList._save_parsed_cache(cache_key, sources)
+
+                _PARSE_CACHE[cache_key] = sources
+                if len(_PARSE_CACHE) > _PARSE_CACHE_SIZE:
+                    _PARSE_CACHE.popitem(last=False)
+
+            self._list = copy.deepcopy(sources)
+            self._reindex()
+            self._create_entries()
         except FileNotFoundError:
             self._list = DEFAULT_SOURCE_LIST
+            self._reindex()
             print("[WARNING] No sourcelist configuration file created, "
                   "substituting with defaults...", file=sys.stderr)
         except yaml.YAMLError as ye:
@@ -289,61 +488,193 @@ class SourceList:
 
     @umask(0o077)
     def save(self):
+        # The YAML emitter writes in many small pieces, so the document is
+        # assembled in memory and written out at once.
+        payload = yaml.dump_yaml({"sources": self._list},
+                                 Dumper=yaml.SourceListDumper).encode()
+
+        try:
+            with open(self.path, 'rb') as listfile:
+                if listfile.read() == payload:
+                    # Nothing changed, keep the file (and its timestamp,
+                    # which the parse caches are keyed on) as it is.
+                    return
+        except OSError:
+            pass
+
+        # Write to a new file first and rename it over the original, so an
+        # interrupted save can not leave a truncated list behind. If the list
+        # is a symbolic link, the file it points to is the one replaced.
+        target = os.path.realpath(self.path)
         try:
-            with open(self.path, 'w') as listfile:
-                data = {"sources": self._list}
-                yaml.dump_yaml(data, listfile, Dumper=yaml.Dumper)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target),
+                                             prefix=os.path.basename(target))
         except FileNotFoundError:
             raise FileNotFoundError("Failed to save source list '%s'"
                                     % self.path)
+        try:
+            with os.fdopen(fd, 'wb') as listfile:
+                listfile.write(payload)
+            try:
+                os.chmod(temp_path, stat.S_IMODE(os.stat(target).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, target)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        path = os.path.abspath(self.path)
+        for cache_key in [key for key in _PARSE_CACHE if key[0] == path]:
+            del _PARSE_CACHE[cache_key]
+        try:
+            os.unlink(os.path.join(cache_directory(), _PARSED_CACHE_FILE))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _load_mapped(listfile):
+        """Parses the YAML document in `listfile` through a read-only memory
+        mapping of the file, with the pages faulted in up front if possible.
+        """
+        flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+        with mmap.mmap(listfile.fileno(), 0,
+                       flags=flags, prot=mmap.PROT_READ) as mapping:
+            return yaml.load_yaml(mapping, Loader=yaml.Loader)
+
+    @staticmethod
+    def _load_parsed_cache(cache_key):
+        """Returns the cached parsed source list if it was made from the file
+        identified by `cache_key`, or None.
+        """
+        try:
+            with open(os.path.join(cache_directory(), _PARSED_CACHE_FILE),
+                      'rb') as cachefile:
+                cached_key, sources = pickle.load(cachefile)
+        except Exception:
+            # A missing or unreadable cache is simply ignored.
+            return None
+
+        return sources if cached_key == cache_key else None
+
+    @staticmethod
+    @umask(0o077)
+    def _save_parsed_cache(cache_key, sources):
+        """Stores the parsed source list for the file identified by
+        `cache_key`. Failing to write the cache is not an error.
+        """
+        try:
+            os.makedirs(cache_directory(), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cache_directory(),
+                                             prefix=_PARSED_CACHE_FILE)
+            try:
+                with os.fdopen(fd, 'wb') as cachefile:
+                    pickle.dump((cache_key, sources), cachefile,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path,
+                           os.path.join(cache_directory(), _PARSED_CACHE_FILE))
+            except Exception:
+                os.unlink(temp_path)
+                raise
+        except Exception:
+            pass
+
+    def _reindex(self):
+        """Recalculate the mapping of source names to their position in the
+        configuration list."""
+        self._roots = None
+        self._index = {entry["name"]: idx
+                       for idx, entry in enumerate(self._list)}
+
+    @staticmethod
+    def _create_entry(entry):
+        """Instantiate the `SourceListEntry` class for a single configured
+        source, or return None if the type of the source is not known."""
+        clazz = SUPPORTED_ENTRIES_BY_KEY.get(entry["type"])
+        if not clazz:
+            return None
+        return clazz(*[opt.from_entry(entry) for opt in clazz.options])
 
     def _create_entries(self):
         """Instantiate the `SourceListEntry` class for the configured sources,
         in order."""
+        names = set()
+        for entry in self._list:
+            if entry["name"] in names:
+                raise ValueError("A source entry with name '%s' is "
+                                 "configured multiple times!" % entry["name"])
+            names.add(entry["name"])
 
-        def _create(clazz, entry):
-            return clazz(*list(map(lambda opt: opt.from_entry(entry),
-                                   clazz.options)))
-
-        self._entries = list()
+        # Sources of an unknown type are skipped.
+        self._entries = [instance for instance
+                         in map(SourceList._create_entry, self._list)
+                         if instance]
 
-        for entry in self._list:
-            type_key = entry["type"]
-            if type_key == "local":
-                self._entries.append(_create(LocalSource, entry))
-            elif type_key == "git repo":
-                self._entries.append(_create(GitRepositorySource, entry))
+    @property
+    def _entries_in_sync(self):
+        """Returns whether `_entries` contains an instance for every element
+        of `_list`, at the same index, so that they can be updated in place.
+        """
+        return self._entries is not None and \
+            len(self._entries) == len(self._list)
 
     @property
     def sources(self):
         """Return the package sources configured."""
-        if not self._entries:
+        if self._entries is None:
             self._create_entries()
-
-        for entry in self._entries:
-            yield entry
+        return self._entries
 
     @property
     def num_sources(self):
         return len(self._list)
 
     def add_source(self, entry):
-        if list(filter(lambda e: e["name"] == entry["name"], self._list)):
+        if entry["name"] in self._index:
             raise KeyError("A source entry with name '%s' already exists!"
                            % entry["name"])
 
+        in_sync = self._entries_in_sync
         self._list.insert(0, entry)
-        self._create_entries()
+        self._reindex()
+
+        instance = SourceList._create_entry(entry) if in_sync else None
+        if instance:
+            self._entries.insert(0, instance)
+        else:
+            self._create_entries()
+
+    def add_source_from_values(self, type_key, values):
+        """Adds a new source of the kind `type_key` to the top of the list,
+        with its options parsed from the `values` mapping instead of being
+        asked for interactively.
+        """
+        try:
+            clazz = SUPPORTED_ENTRIES_BY_KEY[type_key]
+        except KeyError:
+            raise KeyError("There is no source list entry kind '%s'"
+                           % type_key)
+
+        entry = {"type": type_key}
+        for option in clazz.options:
+            entry[option.name] = option.from_dict(values)
+        self.add_source(entry)
 
     def delete_source(self, name):
         try:
-            element = list(filter(lambda e: e["name"] == name, self._list))[0]
-        except IndexError:
+            index = self._index[name]
+        except KeyError:
             raise KeyError("A source entry with name '%s' doesn't exist!"
                            % name)
 
-        self._list.remove(element)
-        self._create_entries()
+        in_sync = self._entries_in_sync
+        del self._list[index]
+        self._reindex()
+
+        if in_sync:
+            del self._entries[index]
+        else:
+            self._create_entries()
 
     def swap_sources(self, name, direction):
         """Moves the source named 'name' up or down on the priority list.
@@ -353,86 +684,129 @@ class SourceList:
             raise ValueError("Invalid direction '%s'" % direction)
 
         try:
-            element = list(filter(lambda e: e["name"] == name, self._list))[0]
-        except IndexError:
+            index = self._index[name]
+        except KeyError:
             raise KeyError("A source entry with name '%s' doesn't exist!"
                            % name)
 
-        index = self._list.index(element)
         if direction == 'UP':
             if index == 0:
                 return
-
-            previous = self._list[index - 1]
-            self._list[index] = previous
-            self._list[index - 1] = element
+            other = index - 1
         elif direction == 'DOWN':
             if index == len(self._list) - 1:
                 return
+            other = index + 1
 
-            following = self._list[index + 1]
-            self._list[index] = following
-            self._list[index + 1] = element
+        self._list[index], self._list[other] = \
+            self._list[other], self._list[index]
+        self._index[self._list[index]["name"]] = index
+        self._index[self._list[other]["name"]] = other
+        self._roots = None
 
-        self._create_entries()
+        if self._entries_in_sync:
+            self._entries[index], self._entries[other] = \
+                self._entries[other], self._entries[index]
+        else:
+            self._create_entries()
         return True
 
-    def _clear_symlinks(self):
-        """Clears the priority list's symbolink links from the user's cache."""
-        directory = os.path.join(cache_directory(), "sourcelist")
-        try:
-            shutil.rmtree(directory)
-        except Exception:
-            pass
-
     @umask(0o077)
-    def _setup_symlinks(self):
+    def _setup_symlinks(self, sources_directory):
         """Creates the symbolic links in the user's cache in order of
-        priority."""
+        priority. Links that already point to the right place are kept, and
+        only the outdated ones are replaced."""
         directory = os.path.join(cache_directory(), "sourcelist")
         os.makedirs(directory, exist_ok=True)
 
         # Calculate how many leading zeroes are to be formatted.
         digits_needed = len(str(len(self._list)))
-        format_str = "{:0" + str(digits_needed) + "d}-{}"
 
+        # Most sources are assembled directly into 'sources_directory', so a
+        # single listing of it tells which of them exist, without a stat()
+        # for each.
+        try:
+            with os.scandir(sources_directory) as listing:
+                listed_dirs = {e.path: e.is_dir() for e in listing}
+        except OSError:
+            listed_dirs = dict()
+
+        def _is_dir(path):
+            is_dir = listed_dirs.get(path)
+            return is_dir if is_dir is not None else os.path.isdir(path)
+
+        missing_links = dict()
         for idx, entry in enumerate(self._entries):
-            if not os.path.isdir(entry.location_on_disk):
-                continue
-            os.symlink(entry.location_on_disk,
-                       os.path.join(directory,
-                                    format_str.format(idx, entry.name)),
-                       target_is_directory=True)
+            if _is_dir(entry.location_on_disk):
+                missing_links[f"{idx:0{digits_needed}d}-{entry.name}"] = \
+                    entry.location_on_disk
+
+        with os.scandir(directory) as listing:
+            for existing in listing:
+                if existing.is_symlink():
+                    if missing_links.get(existing.name) == \
+                            os.readlink(existing.path):
+                        del missing_links[existing.name]
+                        continue
+                    os.unlink(existing.path)
+                elif existing.is_dir(follow_symlinks=False):
+                    shutil.rmtree(existing.path)
+                else:
+                    os.unlink(existing.path)
+
+        if os.symlink not in os.supports_dir_fd:
+            prefix = directory + os.sep
+            for name, target in missing_links.items():
+                os.symlink(target, prefix + name, target_is_directory=True)
+            return
+
+        # Create the links relative to the opened directory, so the path of
+        # the directory is not resolved again by the kernel for every link.
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, target in missing_links.items():
+                os.symlink(target, name, target_is_directory=True,
+                           dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def assemble(self):
         """Assembles the package configuration to be used by the installer."""
-        if not self._entries:
+        if self._entries is None:
             self._create_entries()
 
-        self._clear_symlinks()
-
         directory = os.path.join(data_directory(), "sources.d")
         os.makedirs(directory, exist_ok=True)
 
-        for entry in self._entries:
-            entry.assemble(directory)
+        # Every source is set up in its own subdirectory, so the (mostly
+        # network-bound) work of the sources can be done in parallel.
+        if self._entries:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(
+                    max_workers=min(8, len(self._entries))) as executor:
+                list(executor.map(lambda e: e.assemble(directory),
+                                  self._entries))
 
-        self._setup_symlinks()
+        self._setup_symlinks(directory)
 
     @property
     def roots(self):
         """Return the configured package roots, in the priority order."""
+        if self._roots is not None:
+            return self._roots
+
         directory = os.path.join(cache_directory(), "sourcelist")
 
         # Calculate how many leading zeroes are to be formatted.
         digits_needed = len(str(len(self._list)))
-        format_str = "{:0" + str(digits_needed) + "d}-{}"
 
-        ret = OrderedDict()
+        ret = dict()
         for idx, entry in enumerate(self._list):
-            ret[entry["name"]] = os.path.join(
-                directory, format_str.format(idx, entry["name"]))
+            name = entry["name"]
+            ret[name] = f"{directory}{os.sep}{idx:0{digits_needed}d}-{name}"
 
+        self._roots = ret
         return ret
 
     def filter_roots(self, entry):
@@ -444,7 +818,7 @@ class SourceList:
         if entry is None:
             return roots
 
-        if entry not in self.roots:
+        if entry not in roots:
             raise KeyError("The specified package source '%s' is not "
                            "configured!" % entry)
         return {entry: roots[entry]}
@@ -1,6 +1,19 @@
 from dotfiles.package import K_CONDITIONAL_POSITIVE, K_CONDITIONAL_NEGATIVE
 
 
+# Action arguments are written with spaces in the package descriptors, but are
+# passed as keyword arguments with underscores instead.
+_SPACE_TO_UNDERSCORE = str.maketrans(' ', '_')
+
+# Arguments whose name is a Python keyword, and the name of the parameter they
+# are passed as.
+_KEYWORD_ARGUMENTS = {"from": "from_"}
+
+# The keys under which the conditions of an action arrive to the stage.
+_META_POSITIVE = '$' + K_CONDITIONAL_POSITIVE.replace(' ', '_')
+_META_NEGATIVE = '$' + K_CONDITIONAL_NEGATIVE.replace(' ', '_')
+
+
 class _StageBase:
     """
     The base class from which all stage executors inherit from.
@@ -9,61 +22,54 @@ class _StageBase:
         self.package = package
         self.user_context = user_context
         self.callback = condition_check_callback
+        self.__action_funcs = dict()
 
     def __get_action_func(self, action):
+        fn = self.__action_funcs.get(action)
+        if fn:
+            return fn
+
         if action.startswith('_'):
             raise ValueError("Invalid action '%s' requested: do not try "
                              "accessing execution engine internals!"
                              % action)
 
-        action = action.replace(' ', '_')
+        name = action.translate(_SPACE_TO_UNDERSCORE)
         try:
-            return getattr(self, action)
+            fn = getattr(self, name)
         except AttributeError:
             raise ValueError("Invalid action '%s' for package stage '%s'!"
-                             % (action, type(self).__name__))
+                             % (name, type(self).__name__))
+
+        self.__action_funcs[action] = fn
+        return fn
 
     @staticmethod
     def __cleanup_args(args):
-        return {k.replace(' ', '_')
-                # Need to replace "from" because it is a keyword...
-                .replace("from", "from_"): v
+        return {_KEYWORD_ARGUMENTS.get(k, k).translate(_SPACE_TO_UNDERSCORE): v
                 for k, v in args.items()}
 
-    @staticmethod
-    def __get_meta_key(args, key, default=None):
-        return args.get('$' + key.replace(' ', '_'), default)
-
-    @staticmethod
-    def __delete_meta_key(args, key):
-        try:
-            del args['$' + key.replace(' ', '_')]
-        except KeyError:
-            pass
-        return args
-
     def __evaluate_conditions(self, args):
+        # Take the conditional keys out of the arguments, because the actual
+        # dispatched functions do not understand their meaning.
+        required_conditions = args.pop(_META_POSITIVE, None)
+        blocking_conditions = args.pop(_META_NEGATIVE, None)
+        if not required_conditions and not blocking_conditions:
+            # Most actions are unconditional.
+            return True
+
         # Check the conditions that might apply for the action.
-        required_conditions = self.__get_meta_key(
-            args, K_CONDITIONAL_POSITIVE, list())
-        blocking_conditions = self.__get_meta_key(
-            args, K_CONDITIONAL_NEGATIVE, list())
-        if required_conditions or blocking_conditions:
-            if not self.callback:
-                raise NotImplementedError(
-                    "Conditional execution specified for action, without "
-                    "state callback!")
-            if required_conditions and not self.callback(required_conditions):
-                # Positive conditions did not match, skip the action.
-                return False
-            if blocking_conditions and self.callback(blocking_conditions):
-                # Negative conditions matched, skip the action.
-                return False
-
-        # Remove these conditional keys because the actual dispatched
-        # functions do not understand their meaning.
-        self.__delete_meta_key(args, K_CONDITIONAL_POSITIVE)
-        self.__delete_meta_key(args, K_CONDITIONAL_NEGATIVE)
+        callback = self.callback
+        if not callback:
+            raise NotImplementedError(
+                "Conditional execution specified for action, without "
+                "state callback!")
+        if required_conditions and not callback(required_conditions):
+            # Positive conditions did not match, skip the action.
+            return False
+        if blocking_conditions and callback(blocking_conditions):
+            # Negative conditions matched, skip the action.
+            return False
         return True
 
     def __call__(self, action, **kwargs):
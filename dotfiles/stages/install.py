@@ -1,29 +1,172 @@
-from enum import Enum
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from enum import IntEnum
+import errno
+import locale
+import mmap
 import os
+from pathlib import PurePosixPath
 import re
 import shutil
+import stat
+import subprocess
 import sys
+import tempfile
 
 from .base import _StageBase
 from .shell_mixin import ShellCommandsMixin
 from .remove_mixin import RemoveCommandsMixin
 
 
-class _CopyOrSymlinkAction(Enum):
-    COPY = 32768,
+class _CopyOrSymlinkAction(IntEnum):
+    COPY = 32768
     SYMLINK = 40960
 
 
+# The number of bytes the kernel is asked to copy between files at once.
+_COPY_CHUNK_SIZE = 1 << 20
+
+# Files at least this large are scanned for variables through a memory map
+# instead of being read in their entirety.
+_MMAP_THRESHOLD = 64 * 1024
+
+# The errors with which the in-kernel copy system calls report that they can
+# not be used for the given pair of files.
+_COPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                            errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+
+def _fast_copy2(source, target):
+    """
+    The equivalent of `shutil.copy2` for file targets, implemented through
+    `_fast_copy`.
+    """
+    _fast_copy(source, target)
+    shutil.copystat(source, target)
+    return target
+
+
+def _lstat_or_none(path):
+    """
+    Returns the `os.lstat` result of `path`, or None if it does not exist.
+    """
+    try:
+        return os.lstat(path)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_dir_cached(st, path):
+    """
+    Returns whether `path`, whose `os.lstat` result was `st`, is a directory.
+    The path is only queried again if it is a symbolic link.
+    """
+    if st is None:
+        return False
+    if stat.S_ISLNK(st.st_mode):
+        return os.path.isdir(path)
+    return stat.S_ISDIR(st.st_mode)
+
+
+def _fast_copy(source, target):
+    """
+    Copies the contents of the file `source` to the file `target` without the
+    data passing through the process, if possible: first by copy_file_range(2),
+    which also lets the file system share the data between the files, then by
+    sendfile(2), and finally with a usual buffered copy.
+    """
+    with open(source, 'rb') as src:
+        try:
+            if os.path.samestat(os.fstat(src.fileno()), os.stat(target)):
+                raise shutil.SameFileError("'%s' and '%s' are the same file"
+                                           % (source, target))
+        except FileNotFoundError:
+            pass
+
+        with open(target, 'wb') as dst:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while os.copy_file_range(src_fd, dst_fd,
+                                             _COPY_CHUNK_SIZE):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                        raise
+
+            if hasattr(os, "sendfile"):
+                try:
+                    while os.sendfile(dst_fd, src_fd, None, _COPY_CHUNK_SIZE):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                        raise
+
+            shutil.copyfileobj(src, dst, _COPY_CHUNK_SIZE)
+
+
+def _do_copy(source, target, target_st, relative, log):
+    """
+    Copies the file `source` to `target`, whose `os.lstat` result is
+    `target_st`, or into it if it is a directory. The messages to print are
+    appended to `log`.
+    """
+    log.append("\tCopy '%s' ('%s') -> '%s'"
+               % (source, os.path.abspath(source), target))
+    if _is_dir_cached(target_st, target):
+        target = os.path.join(target, os.path.basename(source))
+    _fast_copy(source, target)
+    shutil.copymode(source, target)
+
+
+def _do_symlink(source, target, target_st, relative, log):
+    """
+    Creates `target`, whose `os.lstat` result is `target_st`, as a symbolic
+    link to `source`, replacing an existing file or link. The messages to
+    print are appended to `log`.
+    """
+    if not relative:
+        symlink_points_to = os.path.abspath(source)
+    else:
+        symlink_points_to = os.path.relpath(source, os.path.dirname(target))
+
+    log.append("\tSymLink '%s' ('%s') -> '%s'"
+               % (source, symlink_points_to, target))
+    try:
+        os.symlink(symlink_points_to, target)
+    except FileExistsError:
+        # Only existing files and links are replaced, directories are not.
+        if target_st is not None and stat.S_ISDIR(target_st.st_mode):
+            raise
+        log.append("\tSymLinkPreparatoryDelete '%s'" % target)
+        os.unlink(target)
+        os.symlink(symlink_points_to, target)
+
+
+_COPY_OR_SYMLINK_HANDLERS = {
+    _CopyOrSymlinkAction.COPY: _do_copy,
+    _CopyOrSymlinkAction.SYMLINK: _do_symlink
+}
+
+
 class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
     """
     The install stage is responsible for unpacking and setting up the package's
     persistent presence on the user's device.
     """
+
+    # Whether the files of a multi-file copy or symlink action are processed
+    # in parallel.
+    PARALLEL_COPY = True
+
     def __init__(self, package, user_context, condition_checker, arg_expand,
                  uninstall_generator):
         super().__init__(package, user_context, condition_checker)
         self.expand_args = arg_expand
         self.uninstall_generator = uninstall_generator
+        self._uservar_cache = {}
+        self._temp_dir = None
 
     def make_dirs(self, dirs):
         """
@@ -31,12 +174,11 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
         exist).
         """
         for dirp in dirs:
-            # Calculate which dirs would be created if they don't exist yet.
-            path_parts = []
-            head, tail = dirp, ''
-            while head:
-                path_parts.append(head)
-                head, tail = os.path.split(head)
+            # Calculate which dirs would be created if they don't exist yet,
+            # the innermost first.
+            path = PurePosixPath(dirp)
+            path_parts = [dirp] + [str(parent) for parent in path.parents
+                                   if str(parent) not in ('.', '/')]
 
             print("\tMakeDirs '%s'" % dirp)
             os.makedirs(self.expand_args(dirp), exist_ok=True)
@@ -48,46 +190,53 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
         Helper method that calculates what a copy/replace/symlink operation
         with the parameters will actually refer as target.
         """
-        target = to
-
-        if prefix or explicitly_include_filename:
-            target = os.path.join(to, os.path.basename(source))
+        if not prefix and not explicitly_include_filename:
+            return to
 
-        if prefix:
-            diren, filen = os.path.split(target)
-            target = os.path.join(diren, prefix + filen)
-
-        return target
+        # This is the same as os.path.join(to, prefix + basename(source)),
+        # but without the generic path handling.
+        filename = prefix + source[source.rfind('/') + 1:]
+        if not to or to.endswith('/'):
+            return to + filename
+        return to + '/' + filename
 
     def _copy_or_symlink(self, action, to, file=None, files=None, from_=None,
                          prefix='', relative=False):
-        if action not in [_CopyOrSymlinkAction.COPY,
-                          _CopyOrSymlinkAction.SYMLINK]:
+        handler = _COPY_OR_SYMLINK_HANDLERS.get(action)
+        if not handler:
             raise ValueError("Must be called with either 'copy' or "
                              "'symlink'")
         if action == _CopyOrSymlinkAction.COPY and relative:
             raise ValueError("A 'relative' copy is meaningless.")
         if file and files:
             raise NameError("%s must specify either (file, to) or "
-                            "(files, to)." % action)
+                            "(files, to)." % action.name.lower())
         if file and prefix:
             raise NameError("If only a single file is specified, use the 'to' "
                             "argument to specify the whole destination name!")
 
         to_original = to
         to = self.expand_args(to)
-        if os.path.abspath(to) != to:
+        if not os.path.isabs(to) or os.path.normpath(to) != to:
             raise ValueError("'to' must be given as an absolute path")
 
-        if files and not os.path.isdir(to):
+        to_is_dir = _is_dir_cached(_lstat_or_none(to), to)
+        if files and not to_is_dir:
             raise NotADirectoryError("'to' must be an existing directory when "
-                                     "%sing multiple files." % action)
+                                     "%sing multiple files."
+                                     % action.name.lower())
+
+        if from_ is not None:
+            from_ = self.expand_args(from_)
+
+        is_symlink = action == _CopyOrSymlinkAction.SYMLINK
 
+        operations = []
         _uninstall_files = []
         for file in (files if files else [file]):
             source = self.expand_args(file)
             if from_ is not None:
-                source = os.path.join(self.expand_args(from_), source)
+                source = os.path.join(from_, source)
 
             # shutil understands both absolute files and directories as
             # targets, but os.symlink does not...
@@ -100,47 +249,74 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
             # the target filename again if the target is written
             # explicitly, as it would create a "dir/file/file" situation.
             copy_target_needs_to_include_filename = \
-                action == _CopyOrSymlinkAction.SYMLINK and \
-                not os.path.isdir(source) and os.path.isdir(to)
+                is_symlink and to_is_dir and \
+                not _is_dir_cached(_lstat_or_none(source), source)
 
             target = self._calculate_copy_target(
                 source, to, prefix,
                 copy_target_needs_to_include_filename)
             target = self.expand_args(target)
-
-            if action == _CopyOrSymlinkAction.COPY:
-                print("\tCopy '%s' ('%s') -> '%s'"
-                      % (source, os.path.abspath(source), target))
-                shutil.copy(source, target)
-            elif action == _CopyOrSymlinkAction.SYMLINK:
-                if os.path.exists(target) and not os.path.isdir(target):
-                    print("\tSymLinkPreparatoryDelete '%s'" % target)
-                    os.unlink(target)
-
-                if not relative:
-                    symlink_points_to = os.path.abspath(source)
-                else:
-                    symlink_points_to = os.path.relpath(
-                        source, os.path.dirname(target))
-
-                print("\tSymLink '%s' ('%s') -> '%s'"
-                      % (source, symlink_points_to, target))
-                os.symlink(symlink_points_to, target)
+            target_st = _lstat_or_none(target)
+            operations.append((source, target, target_st, relative))
 
             # Retain the possible unexpanded variable names in the target
             # files' path.
             unins_path = self._calculate_copy_target(
                 source, to_original, prefix,
                 copy_target_needs_to_include_filename)
-            if os.path.isdir(target) and not os.path.islink(target):
+            # A symlink always replaces the target, but a copy goes into the
+            # existing directory.
+            if not is_symlink and target_st is not None and \
+                    stat.S_ISDIR(target_st.st_mode):
                 unins_path = os.path.join(unins_path, os.path.basename(source))
             _uninstall_files.append(unins_path)
 
-        if _uninstall_files:
-            if files:  # Takes precedence as loop above defined the 'file'.
-                self.uninstall_generator.remove(files=_uninstall_files)
-            elif file:
-                self.uninstall_generator.remove(file=_uninstall_files[0])
+        # The paths are calculated in order above, only the file system
+        # operations themselves are done in parallel. The workers do not
+        # print, their messages are printed in the order of the operations
+        # once every worker is done, so the output is not interleaved.
+        completed = [False] * len(operations)
+        try:
+            if self.PARALLEL_COPY and len(operations) > 4:
+                logs = [list() for _ in operations]
+                with ThreadPoolExecutor(
+                        max_workers=min(8, len(operations))) as executor:
+                    futures = [executor.submit(handler, *operation, log)
+                               for operation, log in zip(operations, logs)]
+                    # Like the serial loop, stop at the first failure: the
+                    # operations that have not started yet are abandoned.
+                    wait(futures, return_when=FIRST_EXCEPTION)
+                    for future in futures:
+                        future.cancel()
+
+                for log in logs:
+                    for message in log:
+                        print(message)
+                for index, future in enumerate(futures):
+                    completed[index] = not future.cancelled() and \
+                        future.exception() is None
+                for future in futures:
+                    if not future.cancelled():
+                        future.result()
+            else:
+                for index, operation in enumerate(operations):
+                    log = list()
+                    try:
+                        handler(*operation, log)
+                    finally:
+                        for message in log:
+                            print(message)
+                    completed[index] = True
+        finally:
+            # Even if an operation failed, the files the others put in place
+            # must be removed by the uninstall.
+            _uninstall_files = [unins_path for unins_path, done
+                                in zip(_uninstall_files, completed) if done]
+            if _uninstall_files:
+                if files:  # Takes precedence as loop above defined 'file'.
+                    self.uninstall_generator.remove(files=_uninstall_files)
+                elif file:
+                    self.uninstall_generator.remove(file=_uninstall_files[0])
 
     def copy(self, to, file=None, files=None, from_=None,
              prefix=''):
@@ -205,7 +381,23 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
 
         to = self.expand_args(to)
         print("\tCopyTree '%s' -> '%s'" % (dirp, to))
-        shutil.copytree(dirp, to,
+        if sys.platform.startswith("linux"):
+            # GNU cp can clone the files on file systems that support it.
+            # Like the copytree() below, it follows symbolic links. If it
+            # fails, e.g. due to a dangling link, the copy is redone.
+            try:
+                subprocess.run(['cp', '--recursive', '--dereference',
+                                '--preserve=mode,timestamps',
+                                '--reflink=auto', '--no-target-directory',
+                                '--', dirp, to],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               check=True)
+                return
+            except (OSError, subprocess.CalledProcessError):
+                pass
+
+        shutil.copytree(dirp, to, copy_function=_fast_copy2,
                         ignore_dangling_symlinks=True, dirs_exist_ok=True)
 
     def replace(self, at, with_file=None, with_files=None, from_=None,
@@ -224,43 +416,65 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
             * with_file[s] -> file[s]
             * prefix: gets applied to the 'file[s]' names
         """
-        for file in (with_files if with_files else [with_file]):
-            if from_ is not None:
-                file = os.path.join(self.expand_args(from_), file)
-            target = self._calculate_copy_target(file, at, prefix)
-            target_real = self.expand_args(
-                self._calculate_copy_target(
-                    self.expand_args(file), at, prefix))
-
-            print("\tReplace '%s' ('%s')..." % (target, target_real))
-            self._save_backup(target, target_real)
-            self.copy(to=target, file=file)
+        # Every original file is backed up into the archive (which is only
+        # opened once) before any of them is overwritten.
+        if from_ is not None:
+            from_ = self.expand_args(from_)
 
-    def _save_backup(self, restore_location_file, content_source_file):
+        copies = []
         with self.user_context.get_package_archive(self.package.name) as zipf:
-            try:
-                zipf.write(content_source_file,
-                           restore_location_file.lstrip('/'))
-                print("\tBackup '%s' ('%s')"
-                      % (restore_location_file, content_source_file))
-                self.uninstall_generator.restore(file=restore_location_file)
-            except FileNotFoundError:
-                print("\tSkipBackup '%s': ENOENT" % restore_location_file)
-                pass
+            for file in (with_files if with_files else [with_file]):
+                if from_ is not None:
+                    file = os.path.join(from_, file)
+                target = self._calculate_copy_target(file, at, prefix)
+                target_real = self.expand_args(
+                    self._calculate_copy_target(
+                        self.expand_args(file), at, prefix))
+
+                print("\tReplace '%s' ('%s')..." % (target, target_real))
+                self._save_backup(target, target_real, zipf)
+                copies.append((target, file))
+
+        for target, file in copies:
+            self.copy(to=target, file=file)
+
+    def _save_backup(self, restore_location_file, content_source_file,
+                     zipf=None):
+        if zipf is None:
+            with self.user_context.get_package_archive(self.package.name) \
+                    as zipf:
+                return self._save_backup(restore_location_file,
+                                         content_source_file, zipf)
+
+        try:
+            zipf.write(content_source_file,
+                       restore_location_file.lstrip('/'))
+            print("\tBackup '%s' ('%s')"
+                  % (restore_location_file, content_source_file))
+            self.uninstall_generator.restore(file=restore_location_file)
+        except FileNotFoundError:
+            print("\tSkipBackup '%s': ENOENT" % restore_location_file)
+            pass
 
     # TODO: Refactor user-given variables to be loaded from memory, not from
     #       a file.
-    uservar_re = re.compile(r'\$<(?P<key>[\w_-]+)>',
-                            re.MULTILINE | re.UNICODE)
+    uservar_re = re.compile(r'\$<(?P<key>[A-Za-z0-9_-]+)>')
 
     def __replace_uservar(self, match):
         var_name = match.group('key')
+        value = self._uservar_cache.get(var_name)
+        if value is not None:
+            return value
+
+        if self._temp_dir is None:
+            self._temp_dir = self.expand_args('$TEMPORARY_DIR')
+
         try:
-            with open(os.path.join(self.expand_args('$TEMPORARY_DIR'),
-                                   'var-' + var_name),
+            with open(os.path.join(self._temp_dir, 'var-' + var_name),
                       'r') as varfile:
                 value = varfile.read()
 
+            self._uservar_cache[var_name] = value
             return value
         except OSError:
             print("Error! Package requested to write user input to file "
@@ -280,22 +494,52 @@ class Install(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
                            "not set." % (var_name, self.package))
         return value
 
+    def _substitute_variables(self, file, replace_fn):
+        """
+        Substitutes the variables matched by `uservar_re` in `file` with the
+        result of `replace_fn`. The file is only rewritten if it changed, and
+        then atomically, by replacing it with a new file.
+        """
+        encoding = locale.getpreferredencoding(False)
+        with open(file, 'rb') as to:
+            if os.fstat(to.fileno()).st_size >= _MMAP_THRESHOLD:
+                # Large files without any variables are not read at all.
+                with mmap.mmap(to.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm.find(b'$<') == -1:
+                        return
+                    content = mm[:]
+            else:
+                content = to.read()
+                if b'$<' not in content:
+                    return
+
+        content = content.decode(encoding)
+        substituted = self.uservar_re.sub(replace_fn, content)
+        if substituted == content:
+            return
+
+        # If 'file' is a symbolic link, the file it points to is rewritten,
+        # and the link is kept.
+        file = os.path.realpath(file)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file),
+                                         prefix='.' + os.path.basename(file))
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                temp.write(substituted.encode(encoding))
+            shutil.copymode(file, temp_path)
+            os.replace(temp_path, file)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
     def replace_user_input(self, file):
         to_file = self.expand_args(file)
         print("\tUserInputSubst '%s'" % to_file)
-        with open(to_file, 'r+') as to:
-            content = to.read()
-            content = re.sub(self.uservar_re, self.__replace_uservar, content)
-            to.seek(0)
-            to.write(content)
-            to.truncate(to.tell())
+        # The variable files are read at most once per substituted file.
+        self._uservar_cache = {}
+        self._substitute_variables(to_file, self.__replace_uservar)
 
     def substitute_environment_variables(self, file):
         to_file = self.expand_args(file)
         print("\tEnvSubst '%s'" % to_file)
-        with open(to_file, 'r+') as to:
-            content = to.read()
-            content = re.sub(self.uservar_re, self.__replace_envvar, content)
-            to.seek(0)
-            to.write(content)
-            to.truncate(to.tell())
+        self._substitute_variables(to_file, self.__replace_envvar)
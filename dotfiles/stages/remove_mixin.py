@@ -1,4 +1,5 @@
 import os
+import stat
 
 from dotfiles.os import restore_working_directory
 
@@ -20,20 +21,30 @@ class RemoveCommandsMixin:
             return saver(*largs)
 
     @restore_working_directory
-    def _removal(self, where, where_expanded, file_list, ignore_missing=True):
+    def _removal(self, where, where_expanded, file_list, ignore_missing=True,
+                 expanded_file_list=None):
         if where_expanded:
             os.chdir(where_expanded)
+        if expanded_file_list is None:
+            expanded_file_list = [self._expand(f) for f in file_list]
 
-        for file_original in file_list:
+        for file_original, file_expanded in zip(file_list,
+                                                expanded_file_list):
             unexpanded_file = os.path.join(where, file_original)
-            real_file = os.path.join(where_expanded,
-                                     self._expand(file_original))
+            real_file = os.path.join(where_expanded, file_expanded)
 
             self.__save_backup(unexpanded_file, real_file)
 
-            if os.path.isfile(real_file) or os.path.islink(real_file):
+            # The working directory is 'where', so the expanded name can be
+            # used as is.
+            try:
+                mode = os.lstat(file_expanded).st_mode
+            except FileNotFoundError:
+                continue
+
+            if stat.S_ISREG(mode) or stat.S_ISLNK(mode):
                 try:
-                    os.unlink(real_file)
+                    os.unlink(file_expanded)
                     print("\tDelete '%s'" % real_file)
                 except FileNotFoundError:
                     if not ignore_missing:
@@ -57,9 +68,15 @@ class RemoveCommandsMixin:
             raise NameError("Remove must specify either file or "
                             "files.")
 
+        # The file names are only expanded once, for both the checks and the
+        # removal.
+        file_list = files if files else [file]
+        expanded_file_list = [self._expand(f) for f in file_list]
+
         if where:
             where_expanded = self._expand(where)
-            if os.path.abspath(where_expanded) != where_expanded:
+            if not os.path.isabs(where_expanded) or \
+                    os.path.normpath(where_expanded) != where_expanded:
                 raise ValueError("'where' must be given as an absolute path")
 
             if file and not os.path.isdir(where_expanded):
@@ -74,11 +91,11 @@ class RemoveCommandsMixin:
         else:
             where = ""
             where_expanded = ""
-            for file_ in (files if files else [file]):
-                file_ = self._expand(file_)
-                if os.path.abspath(file_) != file_:
+            for file_ in expanded_file_list:
+                if not os.path.isabs(file_) or \
+                        os.path.normpath(file_) != file_:
                     raise ValueError("If 'where' is not given, all 'files' "
                                      "(or 'file') must be an absolute path")
 
-        self._removal(where, where_expanded, files if files else [file],
-                      ignore_missing)
+        self._removal(where, where_expanded, file_list, ignore_missing,
+                      expanded_file_list)
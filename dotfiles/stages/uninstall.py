@@ -1,4 +1,3 @@
-from collections import deque
 from functools import wraps
 import inspect
 import os
@@ -60,7 +59,7 @@ class Uninstall(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
 
         for file in (files if files else [file]):
             file_ = self.expand_args(file)
-            if os.path.abspath(file_) != file_:
+            if not os.path.isabs(file_) or os.path.normpath(file_) != file_:
                 raise ValueError("All 'files' (or 'file') must be an "
                                  "absolute path")
 
@@ -69,9 +68,9 @@ class Uninstall(_StageBase, ShellCommandsMixin, RemoveCommandsMixin):
             for file_ in (files if files else [file]):
                 file_real = self.expand_args(file_)
                 try:
-                    buffer = zipf.read(file_)
-                    with open(file_real, 'wb') as target:
-                        target.write(buffer)
+                    with zipf.open(file_) as source, \
+                            open(file_real, 'wb') as target:
+                        shutil.copyfileobj(source, target, 1 << 20)
                     print("\tRestore '%s' ('%s')" % (file_, file_real))
                 except KeyError:
                     print("[WARNING] Won't restore '%s' as a corresponding "
@@ -85,16 +84,23 @@ def _wrap(fun):
     Wraps the executed function with the action store logic for
     `_UninstallSignature`.
     """
+    # The signature is only inspected once, when the function is decorated.
+    params = tuple(p for p in inspect.signature(fun).parameters
+                   if p != 'self')
+    action = fun.__name__
+
     @wraps(fun)
-    def _wrapper(*args, **kwargs):
+    def _wrapper(self, *args, **kwargs):
+        # Calling the function first rejects the invalid invocations.
+        ret = fun(self, *args, **kwargs)
+
         # Save the action's invocation.
-        bind = inspect.signature(fun).bind(*args, **kwargs).arguments
-        save_args = {k: bind[k]
-                     for k in filter(lambda k: k != 'self', bind)}
-        save_args['action'] = fun.__name__
-        bind['self'].register_action(**save_args)
+        save_args = dict(zip(params, args))
+        save_args.update(kwargs)
+        save_args['action'] = action
+        self.register_action(**save_args)
 
-        return fun(*args, **kwargs)
+        return ret
     return _wrapper
 
 
@@ -105,7 +111,9 @@ class UninstallSignature:
     of a package.
     """
     def __init__(self):
-        self.actions = deque()
+        # The actions are stored in the order they were generated, the last
+        # one must be executed first.
+        self.actions = []
 
     def register_action(self, **kwargs):
         """
@@ -113,13 +121,13 @@ class UninstallSignature:
         uninstall.
         """
         args = {k.replace(' ', '_'): v for k, v in kwargs.items()}
-        self.actions.appendleft(args)
+        self.actions.append(args)
 
     def pop(self):
         """
         Removes the last generated uninstall action from the list.
         """
-        self.actions.popleft()
+        self.actions.pop()
 
     # Developer note: keep the methods from `Uninstall` in sync without a body!
 
@@ -60,10 +60,9 @@ def package_temporary_dir(package_name):
     to it.
     """
     package_dir = _PACKAGE_TEMP_DIRS.get(package_name, None)
-    if not package_dir:
-        with TemporaryDir() as root:
-            package_dir = tempfile.mkdtemp(prefix=package_name + '-',
-                                           dir=root.dir)
-            _PACKAGE_TEMP_DIRS[package_name] = package_dir
+    if package_dir:
+        return package_dir
 
-    return package_dir
+    package_dir = tempfile.mkdtemp(prefix=package_name + '-',
+                                   dir=temporary_dir())
+    return _PACKAGE_TEMP_DIRS.setdefault(package_name, package_dir)
@@ -1,14 +1,29 @@
 import os
-import pprint
+import sys
 
 from dotfiles.stages import Stages
 
 
+def _contains(obj, needle):
+    """Returns whether the string `needle` appears in any string in the
+    (nested) `obj` structure of dicts, lists and tuples.
+    """
+    if isinstance(obj, str):
+        return needle in obj
+    if isinstance(obj, dict):
+        return any(_contains(key, needle) or _contains(value, needle)
+                   for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return any(_contains(element, needle) for element in obj)
+    return False
+
+
 class _Transformer:
     def __init__(self, identifier, enabled, affecting_stages):
-        self._identifier = identifier
+        # The identifier is looked up in the metadata of every action.
+        self._identifier = sys.intern(identifier)
         self._enabled = enabled
-        self._affecting_stages = affecting_stages
+        self._affecting_stages = frozenset(affecting_stages)
 
     @property
     def identifier(self):
@@ -28,27 +43,35 @@ class _Transformer:
         raise NotImplementedError("Must be implemented in a subclass!")
 
     @staticmethod
-    def _get_configuration(identifier, action_dict):
+    def _get_configuration(identifier, action_dict, meta_root=None):
         """Retrieve the configuration map for the current transformation."""
-        meta_root = action_dict.get("$transform", dict())
+        if meta_root is None:
+            meta_root = action_dict.get("$transform", dict())
         cfg = meta_root.get(identifier, None)
+        return _Transformer._make_configuration(cfg)
 
-        if cfg is None:
-            return dict()
-        if type(cfg) is dict:
+    @staticmethod
+    def _make_configuration(cfg):
+        """Create the configuration map from the value given for a
+        transformation in an action.
+        """
+        if isinstance(cfg, dict):
             return cfg
-        if type(cfg) is bool:
+        if isinstance(cfg, bool):
             return {"$enabled": cfg}
+        if cfg is None:
+            return dict()
 
         raise TypeError("Expected either a 'bool' for switching transformer, "
                         "or a 'dict' configuration.")
 
-    def _strip_configuration(self, action_dict):
+    def _strip_configuration(self, action_dict, meta_root=None):
         """
         Strip the configuration map of the current transformation from the
         action object.
         """
-        meta_root = action_dict.get("$transform", dict())
+        if meta_root is None:
+            meta_root = action_dict.get("$transform", dict())
         try:
             del meta_root[self.identifier]
         except KeyError:
@@ -58,11 +81,15 @@ class _Transformer:
     def _is_enabled_in(cfg):
         return cfg.get("$enabled", True)
 
-    def __call__(self, stage, action_dict):
+    def __call__(self, stage, action_dict, scanned=None):
         """
         Transforms the given action if the current transformer is enabled and
         if the action does not explicitly prohibit the transformation.
 
+        If the caller already has the result of `scan_transforms` for the
+        action, it can be passed as `scanned` instead of the configuration
+        being looked up again.
+
         Returns
         -------
             The transformed action.
@@ -70,16 +97,23 @@ class _Transformer:
             or a `list` of `dict`s in which case the action was split into
             multiple transformed actions.
         """
-        if stage not in self._affecting_stages:
+        if not self._enabled or stage not in self._affecting_stages:
             return action_dict
 
-        cfg = self._get_configuration(self.identifier, action_dict)
-        if not self._is_enabled_in(cfg):
+        if scanned is not None:
+            meta_root = None
+            enabled, cfg = scanned.get(self.identifier, (True, dict()))
+        else:
+            meta_root = action_dict.get("$transform", dict())
+            cfg = self._get_configuration(self.identifier, action_dict,
+                                          meta_root)
+            enabled = self._is_enabled_in(cfg)
+        if not enabled:
             return action_dict
 
         result = self.transform(cfg, action_dict)
         if result is not None:
-            self._strip_configuration(action_dict)
+            self._strip_configuration(action_dict, meta_root)
         else:
             result = action_dict
         return result
@@ -95,16 +129,19 @@ class _UltimateTransformer(_Transformer):
     def __init__(self):
         pass
 
-    def __call__(self, stage, action_dict):
-        # verify that all the transformations that needed to be run had
+    def __call__(self, stage, action_dict, scanned=None):
+        # The metadata is inspected as it is at this point, after the other
+        # transformers had stripped their configuration, so 'scanned' is not
+        # used.
+        #
+        # Verify that all the transformations that needed to be run had
         # actually executed.
         meta_root = action_dict.get("$transform", dict())
         if not meta_root:
             return action_dict
 
-        for xformer in list(meta_root.keys()):
-            extracted_cfg = \
-                _Transformer._get_configuration(xformer, action_dict)
+        for xformer, cfg in list(meta_root.items()):
+            extracted_cfg = _Transformer._make_configuration(cfg)
 
             if _Transformer._is_enabled_in(extracted_cfg) is False:
                 # Found a configuration in the transformer meta which points
@@ -124,6 +161,20 @@ class _UltimateTransformer(_Transformer):
         return action_dict
 
 
+def scan_transforms(action_dict):
+    """
+    Parses the transformer configurations of the action into a mapping of
+    identifier to an `(is enabled, configuration)` pair, which can be passed to
+    every transformer in a chain instead of each looking it up again.
+    """
+    meta_root = action_dict.get("$transform", dict())
+    scanned = dict()
+    for identifier, cfg in meta_root.items():
+        cfg = _Transformer._make_configuration(cfg)
+        scanned[identifier] = (_Transformer._is_enabled_in(cfg), cfg)
+    return scanned
+
+
 def get_ultimate_transformer():
     return _UltimateTransformer()
 
@@ -158,42 +209,46 @@ class CopiesAsSymlinks(_Transformer):
     def __handle_replace(cls, action):
         def __clean_dict(mapping):
             return {k: v for k, v in mapping.items() if v is not None}
+        prefix = action.get("prefix", None)
+        at = action.get("at", None)
+        with_file = action.get("with file", None)
+        with_files = action.get("with files", None)
+
         # Handling "replace" is harder to make it into a symlink, because the
         # user expects a backup to be available at uninstall.
         remove = __clean_dict(
             {"action": "remove",
              "ignore missing": True,
-             "where": action.get("at", None),
-             "file": cls.__apply_prefix(action.get("prefix", None),
-                                        action.get("with file", None)),
-             "files": list(map(
-                 lambda p: cls.__apply_prefix(action.get("prefix", None), p),
-                 action.get("with files")))
+             "where": at,
+             "file": cls.__apply_prefix(prefix, with_file),
+             "files": [cls.__apply_prefix(prefix, p) for p in with_files]
              if "with files" in action else None
              })
 
         symlink = __clean_dict(
             {"action": "symlink",
              "relative": True,
-             "to": action.get("at", None),
-             "file": action.get("with file", None),
-             "files": action.get("with files", None),
-             "prefix": action.get("prefix", None)
+             "to": at,
+             "file": with_file,
+             "files": with_files,
+             "prefix": prefix
              })
 
         return [remove, symlink]
 
+    # The handlers of the actions that are transformed, keyed by action name.
+    _HANDLERS = {"copy": __handle_copy.__func__,
+                 "replace": __handle_replace.__func__}
+
     def transform(self, xform_config, action):
-        if action["action"] not in ["copy", "replace"]:
+        handler = self._HANDLERS.get(action["action"])
+        if handler is None:
             return action
 
-        if "$TEMPORARY_DIR" in pprint.pformat(action):
+        if _contains(action, "$TEMPORARY_DIR"):
             # Do not do anything with the action if the temporary installer
             # directory is mentioned. It must stay as-is, because the symlink
             # would dangle after the install session.
             return [action]
 
-        if action["action"] == "copy":
-            return self.__handle_copy(action)
-        if action["action"] == "replace":
-            return self.__handle_replace(action)
+        return handler(type(self), action)
@@ -3,6 +3,10 @@ the process if it can't be done."""
 
 # flake8: noqa
 
+import os
+
+from dotfiles.os import cache_directory, umask
+
 try:
     from yaml import YAMLError
     from yaml import load as load_yaml
@@ -12,12 +16,54 @@ try:
         # Get the faster version of the loader, if possible.
         from yaml import CSafeLoader as Loader
         from yaml import CSafeDumper as Dumper
+        USING_C_YAML = True
     except ImportError:
         # NOTE: Installing "LibYAML" requires compiling from source, so in
         # case the current environment does not have it, just fall back to
         # the pure Python (thus slower) implementation.
         from yaml import SafeLoader as Loader
         from yaml import SafeDumper as Dumper
+        USING_C_YAML = False
+
+        import sys
+        print("[WARNING] The YAML package for the current Python interpreter "
+              "was built without LibYAML, parsing will be considerably "
+              "slower.\n"
+              "Reinstall 'PyYAML' with the 'libyaml' development headers "
+              "present to fix this.",
+              file=sys.stderr)
+
+    class PackageLoader(Loader):
+        """
+        The loader for package descriptors, which only contain strings,
+        integers, booleans, and nulls in lists and mappings. Plain scalars are
+        not tried against the other implicit types (floats, timestamps, etc.)
+        of the generic loader, and are kept as strings.
+        """
+        pass
+
+    _PACKAGE_IMPLICIT_TAGS = {"tag:yaml.org,2002:bool",
+                              "tag:yaml.org,2002:int",
+                              "tag:yaml.org,2002:merge",
+                              "tag:yaml.org,2002:null"}
+    PackageLoader.yaml_implicit_resolvers = {
+        first_char: [(tag, regexp) for tag, regexp in resolvers
+                     if tag in _PACKAGE_IMPLICIT_TAGS]
+        for first_char, resolvers in Loader.yaml_implicit_resolvers.items()}
+
+    class SourceListDumper(Dumper):
+        """
+        The dumper for the source list, which is a list of flat mappings that
+        never share a node. Mappings are emitted in block style, in insertion
+        order, and no anchors are computed for the nodes.
+        """
+        def ignore_aliases(self, data):
+            return True
+
+    SourceListDumper.add_representer(
+        dict,
+        lambda dumper, data: dumper.represent_mapping(
+            "tag:yaml.org,2002:map", data.items(), flow_style=False))
 except ImportError:
     import sys
     print("The YAML package for the current Python interpreter cannot be "
@@ -26,3 +72,75 @@ except ImportError:
           "to try and fix this error.",
           file=sys.stderr)
     sys.exit(-1)
+
+
+# The directory under the user's cache where the parsed documents are kept.
+_PARSED_CACHE_DIRECTORY = "parsed-yaml"
+
+
+def load_yaml_file(path, Loader=Loader, buffering=-1, cache=True):
+    """
+    Loads the YAML document in the file at `path` with the given `Loader`.
+
+    If `cache` is True, the result is also pickled into the user's cache,
+    keyed on the path, modification time and size of the file, so that later
+    runs do not parse an unchanged file again. Files at paths that are not
+    stable between runs (e.g. in temporary directories) must not be cached,
+    as their entries would never be read again.
+    """
+    import hashlib
+    import pickle
+
+    if not cache:
+        with open(path, 'rb', buffering=buffering) as datafile:
+            return load_yaml(datafile, Loader=Loader)
+
+    path = os.path.abspath(path)
+    stat_result = os.stat(path)
+    cache_key = (path, stat_result.st_mtime_ns, stat_result.st_size,
+                 Loader.__module__ + '.' + Loader.__qualname__)
+    cache_file = os.path.join(
+        cache_directory(), _PARSED_CACHE_DIRECTORY,
+        hashlib.sha1(path.encode()).hexdigest() + ".pickle")
+
+    try:
+        with open(cache_file, 'rb') as cachefile:
+            cached_key, data = pickle.load(cachefile)
+        if cached_key == cache_key:
+            return data
+    except Exception:
+        # A missing or unreadable cache is simply ignored.
+        pass
+
+    # The YAML loader decodes the raw bytes itself, there is no need for a
+    # text-mode wrapper around the file.
+    with open(path, 'rb', buffering=buffering) as datafile:
+        data = load_yaml(datafile, Loader=Loader)
+
+    _save_parsed_cache(cache_file, cache_key, data)
+    return data
+
+
+@umask(0o077)
+def _save_parsed_cache(cache_file, cache_key, data):
+    """
+    Pickles the parsed `data` into `cache_file`. Failing to write the cache is
+    not an error.
+    """
+    import pickle
+    import tempfile
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file),
+                                         prefix=os.path.basename(cache_file))
+        try:
+            with os.fdopen(fd, 'wb') as cachefile:
+                pickle.dump((cache_key, data), cachefile,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_file)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+    except Exception:
+        pass